@@ -1,6 +1,11 @@
-import json, sqlite3, click, functools, os, hashlib, time, sys, re, bcrypt, secrets
-from flask import Flask, current_app, g, session, redirect, render_template, url_for, request
+import json, sqlite3, click, contextlib, functools, os, hashlib, hmac, time, datetime, sys, re, bcrypt, secrets, threading
+from concurrent.futures import ThreadPoolExecutor
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+import jinja2
+from flask import Flask, Response, current_app, g, session, redirect, render_template, stream_template, url_for, request
 from flask_wtf import CSRFProtect
+from flask_wtf.csrf import generate_csrf
 from markupsafe import escape
 
 from flask_limiter import Limiter
@@ -10,7 +15,61 @@ from flask_limiter.util import get_remote_address
 ### DATABASE FUNCTIONS ###
 
 def connect_db():
-    return sqlite3.connect(app.database)
+    # keep every statement the app issues in sqlite3's prepared statement cache
+    return sqlite3.connect(app.database, cached_statements=256)
+
+# IF NOT EXISTS, so databases created before the indexes were added get them on startup
+DB_INDEXES = """
+             CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users(username);
+             CREATE INDEX IF NOT EXISTS idx_notes_assoc ON notes(assocUser);
+             CREATE INDEX IF NOT EXISTS idx_notes_pub ON notes(publicID);
+             """
+
+_local = threading.local()
+_db_prepared = False
+_db_prepared_lock = threading.Lock()
+
+def prepare_db(db):
+    """One-off setup for settings and indexes that are stored in the database file itself"""
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(DB_INDEXES)
+    wrap_bcrypt_hashes(db)
+
+# The connection is reused for every request its thread serves. That pays off under
+# mod_wsgi's persistent thread pool; Werkzeug's threaded server (python3 app.py) starts
+# a thread per request, so there it is still opened once per request. prepare_db() runs
+# once per process, each new connection only sets the cheap per-connection pragmas.
+def get_db():
+    """Returns this thread's database connection, opening it on first use"""
+    global _db_prepared
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = connect_db()
+        try:
+            if not _db_prepared:
+                with _db_prepared_lock:
+                    if not _db_prepared:
+                        prepare_db(db)
+                        _db_prepared = True
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA temp_store=MEMORY")
+        except:
+            # don't keep a half-configured connection, the next call starts over
+            db.close()
+            raise
+        _local.db = db
+    return db
+
+@contextlib.contextmanager
+def cursor():
+    """Yields a cursor on this thread's connection, committing on success and rolling back on error"""
+    db = get_db()
+    try:
+        yield db.cursor()
+        db.commit()
+    except:
+        db.rollback()
+        raise
 
 def init_db():
     """Initializes the database with our great SQL schema"""
@@ -36,17 +95,16 @@ def init_db():
                         publicID    INTEGER  NOT NULL
                     );
                     """)
+    c.executescript(DB_INDEXES)
 
     # TODO: change to safer passwords (but for testing reason leaving it)
-    c.execute("INSERT INTO users(username, password) VALUES (?, ?)",
-              ("admin", hash_password("password")))
-    c.execute("INSERT INTO users(username, password) VALUES (?, ?)",
-              ("bernardo", hash_password("omgMPC")))
+    c.executemany("INSERT INTO users(username, password) VALUES (?, ?)",
+                  [("admin", hash_password("password")),
+                   ("bernardo", hash_password("omgMPC"))])
 
-    c.execute("INSERT INTO notes(assocUser, dateWritten, note, publicID) VALUES (?, ?, ?, ?)",
-              (2, "1993-09-23 10:10:10", "hello my friend", 1234567890))
-    c.execute("INSERT INTO notes(assocUser, dateWritten, note, publicID) VALUES (?, ?, ?, ?)",
-              (2, "1993-09-23 12:10:10", "i want lunch pls", 1234567891))
+    c.executemany("INSERT INTO notes(assocUser, dateWritten, note, publicID) VALUES (?, ?, ?, ?)",
+                  [(2, "1993-09-23 10:10:10", "hello my friend", 1234567890),
+                   (2, "1993-09-23 12:10:10", "i want lunch pls", 1234567891)])
 
     db.commit()
     db.close()
@@ -54,24 +112,117 @@ def init_db():
 
 ### SECURITY FUNCTIONS ###
 
+_NOTEID = re.compile(r"\d{10}")
+_SPECIALS = frozenset("!@#$%^&*(),.?\":{}|<>")
+
 def validate_password(password):
     if len(password) < 13:
         return "Password must be at least 13 characters"
-    if not re.search(r"[A-Z]", password):
+    # single pass over the password, collecting which character classes occur
+    need = 0
+    for ch in password:
+        if "A" <= ch <= "Z":
+            need |= 1
+        elif "a" <= ch <= "z":
+            need |= 2
+        elif "0" <= ch <= "9":
+            need |= 4
+        elif ch in _SPECIALS:
+            need |= 8
+    if not need & 1:
         return "Password must include at least one uppercase letter"
-    if not re.search(r"[a-z]", password):
+    if not need & 2:
         return "Password must include at least one lowercase letter"
-    if not re.search(r"[0-9]", password):
+    if not need & 4:
         return "Password must include at least one number"
-    if not re.search(r"[!@#$%^&*(),.?\":{}|<>]", password):
+    if not need & 8:
         return "Password must include at least one special character"
     return None
 
+def new_public_id():
+    """Draws a random 10-digit public note ID"""
+    while True:
+        # 34 random bits cover every 10-digit number, reject the draws outside that range
+        candidate = secrets.randbits(34)
+        if 10**9 <= candidate < 10**10:
+            return candidate
+
+# Stored hashes are bcrypt wrapped in argon2id: the bcrypt salt ($2b$<cost>$ + 22 chars)
+# followed by the argon2id hash of the full bcrypt hash. Every account, including the
+# old bcrypt-only ones wrapped by wrap_bcrypt_hashes(), and the dummy hash for unknown
+# usernames cost the same bcrypt + argon2id to verify, so timing does not reveal which
+# usernames exist.
+BCRYPT_SALT_LENGTH = 29
+# bcrypt only reads the first 72 bytes; older bcrypt releases truncated silently, newer ones raise
+BCRYPT_MAX_PASSWORD = 72
+
+def is_wrapped(hashed):
+    return hashed[BCRYPT_SALT_LENGTH:].startswith(b"$argon2id$")
+
+def _wrap(hasher, bcrypt_hash):
+    return bcrypt_hash[:BCRYPT_SALT_LENGTH] + hasher.hash(bcrypt_hash).encode('utf-8')
+
+def _hash_chain(hasher, password, salt):
+    return _wrap(hasher, bcrypt.hashpw(password, salt))
+
+def _verify_chain(hasher, hashed, password):
+    try:
+        inner = bcrypt.hashpw(password, hashed[:BCRYPT_SALT_LENGTH])
+        return hasher.verify(hashed[BCRYPT_SALT_LENGTH:].decode('utf-8'), inner)
+    except (ValueError, VerificationError, InvalidHashError):
+        return False
+
 def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=12))
+    salt = bcrypt.gensalt(rounds=app.config['BCRYPT_ROUNDS'])
+    return app.hash_pool.submit(_hash_chain, app.password_hasher, password.encode('utf-8')[:BCRYPT_MAX_PASSWORD], salt).result()
+
+def needs_rehash(hashed):
+    """True if the stored hash was made with other bcrypt or argon2 parameters than configured"""
+    if not is_wrapped(hashed) or int(hashed[4:6]) != app.config['BCRYPT_ROUNDS']:
+        return True
+    return app.password_hasher.check_needs_rehash(hashed[BCRYPT_SALT_LENGTH:].decode('utf-8'))
 
 def verify_password(hashed, password):
-    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+    return app.hash_pool.submit(_verify_chain, app.password_hasher, hashed, password.encode('utf-8')[:BCRYPT_MAX_PASSWORD]).result()
+
+def wrap_bcrypt_hashes(db):
+    """Wraps stored bcrypt-only hashes in argon2id, without needing the passwords"""
+    for userid, hashed in db.execute("SELECT id, password FROM users").fetchall():
+        if hashed.startswith(b"$2") and not is_wrapped(hashed):
+            # the password check keeps a concurrent wrap by another process from being wrapped twice
+            db.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?",
+                       (_wrap(app.password_hasher, hashed), userid, hashed))
+    db.commit()
+
+# Recently verified credentials, so repeated logins skip the KDF cost.
+# Keyed by (username, HMAC of the password), never the password itself.
+VERIFIED_TTL = 30
+VERIFIED_MAX_ENTRIES = 1024
+_verified = {}
+_verified_lock = threading.Lock()
+
+def password_token(password):
+    return hmac.new(app.secret_key, password.encode('utf-8'), hashlib.sha256).digest()
+
+def check_credentials(username, hashed, password):
+    """Like verify_password, but answers from the cache when the same credentials were verified recently"""
+    key = (username, password_token(password))
+    now = time.monotonic()
+    with _verified_lock:
+        entry = _verified.get(key)
+    # the cached hash must still match the stored one, so a password change invalidates the entry
+    if entry is not None and entry[1] > now and hmac.compare_digest(entry[0], hashed):
+        return True
+    if not verify_password(hashed, password):
+        return False
+    with _verified_lock:
+        if len(_verified) >= VERIFIED_MAX_ENTRIES:
+            for k in [k for k, (_, expiry) in _verified.items() if expiry <= now]:
+                del _verified[k]
+            if len(_verified) >= VERIFIED_MAX_ENTRIES:
+                _verified.clear()
+        _verified[key] = (hashed, now + VERIFIED_TTL)
+    return True
 
 
 
@@ -79,17 +230,34 @@ def verify_password(hashed, password):
 app = Flask(__name__)
 app.database = "db.sqlite3"
 app.secret_key = os.urandom(32)
+app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache()
 csrf = CSRFProtect(app)
 app.config['SESSION_COOKIE_SECURE'] = True
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+# the stored bcrypt hashes are cost 12; all accounts must share one cost for equal login timing
+app.config['BCRYPT_ROUNDS'] = 12
+app.config['ARGON2_TIME_COST'] = int(os.environ.get('ARGON2_TIME_COST', 2))
+app.config['ARGON2_MEMORY_COST'] = int(os.environ.get('ARGON2_MEMORY_COST', 65536))
+app.config['ARGON2_PARALLELISM'] = int(os.environ.get('ARGON2_PARALLELISM', 2))
+app.password_hasher = PasswordHasher(time_cost=app.config['ARGON2_TIME_COST'],
+                                     memory_cost=app.config['ARGON2_MEMORY_COST'],
+                                     parallelism=app.config['ARGON2_PARALLELISM'])
+# bcrypt and argon2-cffi release the GIL, so threads spread the KDF work across cores;
+# the pool size also caps how many 64 MiB argon2 jobs run at once
+app.hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+# checked against for unknown usernames, so they cost the same single KDF call as known ones;
+# built here so no login request pays for creating it
+app.dummy_hash = hash_password(secrets.token_hex(16))
 
 # Setup rate limiting
+# single process, in-memory store: fixed-window is one counter increment per limit
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["500 per day", "100 per hour"],
-    storage_uri="memory://"
+    storage_uri="memory://",
+    strategy="fixed-window"
 )
 
 ### ADMINISTRATOR'S PANEL ###
@@ -101,6 +269,13 @@ def login_required(view):
         return view(**kwargs)
     return wrapped_view
 
+@app.teardown_appcontext
+def release_db(exception):
+    # the connection outlives the request, so don't hand a half-done transaction to the next one
+    db = getattr(_local, 'db', None)
+    if db is not None and db.in_transaction:
+        db.rollback()
+
 @app.after_request
 def set_security_headers(response):
     response.headers['X-Frame-Options'] = 'DENY'
@@ -135,65 +310,57 @@ def notes():
             else:
                 note_data = note_input 
                 try:
-                    db = connect_db()
-                    c = db.cursor()
-                    c.execute("""INSERT INTO notes(id,assocUser,dateWritten,note,publicID) VALUES(null,?,?,?,?)""", (
-                        session['userid'], time.strftime('%Y-%m-%d %H:%M:%S'), note_data, secrets.randbelow(10**10)))
-                    db.commit()
+                    with cursor() as c:
+                        # the insert only happens if the drawn public ID is still free, retry on a collision
+                        for _ in range(5):
+                            publicid = new_public_id()
+                            c.execute("""INSERT INTO notes(id,assocUser,dateWritten,note,publicID)
+                                         SELECT null,?,?,?,? WHERE NOT EXISTS (SELECT 1 FROM notes WHERE publicID = ?)""", (
+                                session['userid'], datetime.datetime.now().isoformat(sep=' ', timespec='seconds'), note_data, publicid, publicid))
+                            if c.rowcount == 1:
+                                break
+                        else:
+                            raise sqlite3.IntegrityError("could not find a free public note ID")
                 except Exception as e:
                     # potential db error
                     importerror = "An error occurred while saving the note."
-                finally:
-                    if 'db' in locals():
-                        db.close()
 
         elif submit_button == 'import note':
             noteid_input = request.form.get('noteid', '').strip()
             
             # checking if the input is a 10-digit number 
-            if not re.fullmatch(r'^\d{10}$', noteid_input):
+            if not _NOTEID.fullmatch(noteid_input):
                 importerror = "Invalid Note ID format. It must be a 10-digit number."
             else:
                 noteid = noteid_input
                 try:
-                    db = connect_db()
-                    c = db.cursor()
-                    c.execute("SELECT * FROM notes WHERE publicID = ?", (noteid,))
-                    result = c.fetchall()
-                    
-                    if len(result) > 0:
-                        row = result[0]
-                        imported_note_content = row[3]
-                        if len(imported_note_content) > MAX_NOTE_LENGTH:
-                            importerror = f"Imported note is too long. Max length is {MAX_NOTE_LENGTH} characters."
-                        else:
-                            c.execute("""INSERT INTO notes(id,assocUser,dateWritten,note,publicID) VALUES(null, ?, ?, ?, ?)""", (
-                                session['userid'], row[2], row[3], row[4]))
-                        
+                    with cursor() as c:
+                        # copies the first note with that ID in one statement, notes over the length limit are skipped
+                        c.execute("""INSERT INTO notes(id,assocUser,dateWritten,note,publicID)
+                                     SELECT null, ?, dateWritten, note, publicID FROM notes
+                                     WHERE publicID = ? AND length(note) <= ? ORDER BY id LIMIT 1""", (
+                            session['userid'], noteid, MAX_NOTE_LENGTH))
+
+                        if c.rowcount == 1:
                             importerror = "Note imported successfully!"
-                    else:
-                        importerror = "No such note with that ID!"
-                    
-                    db.commit()
+                        else:
+                            importerror = "No such note with that ID!"
                 except Exception as e:
                     importerror = "An error occurred during note import."
-                finally:
-                    if 'db' in locals():
-                        db.close()
 
     
     notes = []
     try:
-        db = connect_db()
-        c = db.cursor()
-        c.execute("SELECT * FROM notes WHERE assocUser = ?", (session['userid'],))
-        notes = c.fetchall()
+        with cursor() as c:
+            # fetched here rather than while streaming, so a DB error still ends up in importerror
+            notes = c.execute("SELECT id, dateWritten, note, publicID FROM notes WHERE assocUser = ?", (session['userid'],)).fetchall()
     except Exception as e:
         importerror = "Could not retrieve notes due to a server error."
-    finally:
-        if 'db' in locals():
-            db.close()
-    return render_template('notes.html', notes=notes, importerror=importerror)
+    # the session cookie goes out before a streamed body is rendered, so the CSRF secret
+    # the template's csrf_token() needs must be in the session before streaming starts
+    generate_csrf()
+    # streamed, so the page is sent in chunks instead of being built up as one string
+    return Response(stream_template('notes.html', notes=notes, importerror=importerror))
 
 
 @app.route("/login/", methods=('GET', 'POST'))
@@ -203,16 +370,23 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        db = connect_db()
-        c = db.cursor()
-        c.execute("SELECT * FROM users WHERE username = ?", (username,))
-        result = c.fetchall()
+        with cursor() as c:
+            user = c.execute("SELECT id, username, password FROM users WHERE username = ?", (username,)).fetchone()
 
-        if len(result) > 0 and verify_password(result[0][2], password):
+        if user is not None:
+            authenticated = check_credentials(username, user[2], password)
+        else:
+            verify_password(app.dummy_hash, password)
+            authenticated = False
+
+        if authenticated:
+            if needs_rehash(user[2]):
+                with cursor() as c:
+                    c.execute("UPDATE users SET password = ? WHERE id = ?", (hash_password(password), user[0]))
             session.clear()
             session['logged_in'] = True
-            session['userid'] = result[0][0]
-            session['username'] = result[0][1]
+            session['userid'] = user[0]
+            session['username'] = user[1]
             return redirect(url_for('index'))
         else:
             error = "Wrong username or password!"
@@ -228,24 +402,27 @@ def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        db = connect_db()
-        c = db.cursor()
-
         errormsg = validate_password(password)
         if errormsg:
             errored = True
             passworderror = errormsg
 
-        c.execute("SELECT * FROM users WHERE username = ?", (username,))
-        if len(c.fetchall()) > 0:
-            errored = True
-            usererror = "Please choose an other username."
+        with cursor() as c:
+            if c.execute("SELECT 1 FROM users WHERE username = ? LIMIT 1", (username,)).fetchone() is not None:
+                errored = True
+                usererror = "Please choose an other username."
 
         if not errored:
             hashed = hash_password(password)
-            c.execute("""INSERT INTO users(id,username,password) VALUES(null, ?, ?)""", (username, hashed))
-            db.commit()
-            db.close()
+            try:
+                with cursor() as c:
+                    c.execute("""INSERT INTO users(id,username,password) VALUES(null, ?, ?)""", (username, hashed))
+            except sqlite3.IntegrityError:
+                # a concurrent registration took the name after the check above
+                errored = True
+                usererror = "Please choose an other username."
+
+        if not errored:
             return f"""<html>
                         <head>
                             <meta http-equiv="refresh" content="2;url=/" />
@@ -255,9 +432,6 @@ def register():
                         </body>
                         </html>
                         """
-
-        db.commit()
-        db.close()
     return render_template('register.html', usererror=usererror, passworderror=passworderror)
 
 